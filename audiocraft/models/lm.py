@@ -498,8 +498,9 @@ class LMModel(StreamingModule):
                     cfg_coef=cfg_coef, two_step_cfg=two_step_cfg)
                 # ensure the tokens that should be masked are properly set to special_token_id
                 # as the model never output special_token_id
+                # (torch.where rather than boolean indexing, which would sync with the host every step)
                 valid_mask = mask[..., offset:offset+1].expand(B, -1, -1)
-                next_token[~valid_mask] = self.special_token_id
+                next_token = torch.where(valid_mask, next_token, self.special_token_id)
                 # ensure we don't overwrite prompt tokens, we only write over unknown tokens
                 # (then mask tokens should be left as is as well, which is correct)
                 gen_sequence[..., offset:offset+1] = torch.where(
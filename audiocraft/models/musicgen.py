@@ -407,6 +407,7 @@ class MusicGen:
                     all_tokens.append(gen_tokens)
                 else:
                     all_tokens.append(gen_tokens[:, :, prompt_tokens.shape[-1]:])
+                # The overlap is carried over as tokens, the audio is never re-encoded.
                 prompt_tokens = gen_tokens[:, :, stride_tokens:]
                 prompt_length = prompt_tokens.shape[-1]
                 current_gen_offset += stride_tokens
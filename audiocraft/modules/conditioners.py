@@ -426,6 +426,9 @@ class T5Conditioner(TextConditioner):
         self.normalize_text = normalize_text
         if normalize_text:
             self.text_normalizer = WhiteSpaceTokenizer(1, lemma=True, stopwords=True)
+        # Last (inputs, output) pair, reused when the same text is encoded again,
+        # e.g. for every chunk of an extended generation.
+        self._last_encoding: tp.Optional[tp.Tuple[tp.Dict[str, torch.Tensor], ConditionType]] = None
 
     def tokenize(self, x: tp.List[tp.Optional[str]]) -> tp.Dict[str, torch.Tensor]:
         # if current sample doesn't have a certain attribute, replace with empty string
@@ -446,12 +449,30 @@ class T5Conditioner(TextConditioner):
         mask[empty_idx, :] = 0  # zero-out index where the input is non-existant
         return inputs
 
+    def clear_cache(self):
+        """Drop the cached encoding of the last text inputs."""
+        self._last_encoding = None
+
+    def _is_cached(self, inputs: tp.Dict[str, torch.Tensor]) -> bool:
+        if self._last_encoding is None:
+            return False
+        cached_inputs, _ = self._last_encoding
+        return cached_inputs.keys() == inputs.keys() and all(
+            cached_inputs[key].shape == value.shape and torch.equal(cached_inputs[key], value)
+            for key, value in inputs.items())
+
     def forward(self, inputs: tp.Dict[str, torch.Tensor]) -> ConditionType:
+        use_cache = not self.training and not self.finetune
+        if use_cache and self._is_cached(inputs):
+            assert self._last_encoding is not None
+            return self._last_encoding[1]
         mask = inputs['attention_mask']
         with torch.set_grad_enabled(self.finetune), self.autocast:
             embeds = self.t5(**inputs).last_hidden_state
         embeds = self.output_proj(embeds.to(self.output_proj.weight))
         embeds = (embeds * mask.unsqueeze(-1))
+        if use_cache:
+            self._last_encoding = ({key: value.clone() for key, value in inputs.items()}, (embeds, mask))
         return embeds, mask
 
 
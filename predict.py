@@ -1,29 +1,41 @@
 # Prediction interface for Cog ⚙️
 # https://github.com/replicate/cog/blob/main/docs/python.md
 
+import gc
 import os
 import random
+import shutil
+import tempfile
 import time
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 from cog import BasePredictor, Input, Path
 import torch
 import torchaudio
-import subprocess
-import typing as tp
 import numpy as np
 
 from audiocraft.models import MusicGen, MultiBandDiffusion
+from audiocraft.modules.conditioners import T5Conditioner
 from audiocraft.models.loaders import (
     load_compression_model,
     load_lm_model,
 )
-from audiocraft.data.audio import audio_write
+from audiocraft.data.audio_utils import i16_pcm, normalize_audio
 from weights_downloader import WeightsDownloader
 
 MODEL_PATH = "/src/models/"
 os.environ["HF_HOME"] = MODEL_PATH
 os.environ["TRANSFORMERS_OFFLINE"] = "1"
 os.environ["TORCH_HOME"] = MODEL_PATH
+DEFAULT_DURATION = 8
+# Upper bound on the number of descriptions decoded together in one request.
+MAX_BATCH = 4
+MODEL_VERSIONS = ["stereo-melody-large", "stereo-large", "melody-large", "large"]
+MAX_LOADED_MODELS = int(os.environ.get("MAX_LOADED_MODELS", "1"))
+if MAX_LOADED_MODELS < 1:
+    raise ValueError("MAX_LOADED_MODELS must be at least 1.")
+TMPFS_DIR = "/dev/shm"
 
 
 class Predictor(BasePredictor):
@@ -31,16 +43,50 @@ class Predictor(BasePredictor):
         """Load the model into memory to make running multiple predictions efficient"""
         start = time.time()
         self.weights_downloader = WeightsDownloader()
-        for model, dest in [
+        weights = [
             ("955717e8-8726e21a.th", "models/hub/checkpoints"),
             ("models--facebook--musicgen-small", "models/hub"),
             ("models--facebook--encodec_32khz", "models/hub"),
             ("models--t5-base", "models/hub"),
-        ]:
-            self.weights_downloader.download_weights(model, dest)
+        ]
+        # Fetch every model variant up front, same destination as _load_model.
+        weights += [
+            (f"models--facebook--musicgen-{model_version}", "models")
+            for model_version in MODEL_VERSIONS
+        ]
+        # Downloads are network bound: run them concurrently.
+        with ThreadPoolExecutor(max_workers=len(weights)) as pool:
+            list(
+                pool.map(
+                    lambda args: self.weights_downloader.download_weights(*args),
+                    weights,
+                )
+            )
 
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.loaded_models = {}
+        # Only the torch RNGs drive sampling, so these are seeded once here.
+        set_all_seeds(0)
+        # Let cuDNN autotune the EnCodec convolutions once per input shape.
+        torch.backends.cudnn.benchmark = True
+        # Least recently used model first.
+        self.loaded_models = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.output_dir = None
+
+        # Load the default model and run a generation at the default duration, so
+        # CUDA initialization and cuDNN autotuning for the shapes served by
+        # default happen before the first request.
+        print("Warming up stereo-melody-large...")
+        model = self._load_model(
+            model_path=MODEL_PATH,
+            model_id="facebook/musicgen-stereo-melody-large",
+            model_version="stereo-melody-large",
+        )
+        self.loaded_models["stereo-melody-large"] = model
+        model.set_generation_params(duration=DEFAULT_DURATION)
+        with torch.inference_mode():
+            model.generate(descriptions=["warmup"], progress=False)
+        clear_text_cache(model)
 
         elapsed_time = time.time() - start
         print(f"Setup time: {elapsed_time:.2f}s")
@@ -58,31 +104,46 @@ class Predictor(BasePredictor):
         compression_model = load_compression_model(
             model_id, device=self.device, cache_dir=model_path
         )
-        lm = load_lm_model(model_id, device=self.device, cache_dir=model_path)
+        # On GPU, the LM attention goes through torch's fused
+        # scaled_dot_product_attention rather than the einsum path.
+        lm = load_lm_model(
+            model_id,
+            device=self.device,
+            cache_dir=model_path,
+            memory_efficient=True if self.device == "cuda" else None,
+        )
 
-        return MusicGen(model_id, compression_model, lm)
+        model = MusicGen(model_id, compression_model, lm)
+        model.set_custom_progress_callback(log_progress)
+        return model
+
+    def _load_mbd(self) -> MultiBandDiffusion:
+        print("Loading MultiBandDiffusion...")
+        self.weights_downloader.download_weights(
+            "models--facebook--multiband-diffusion", "models/hub"
+        )
+        mbd = MultiBandDiffusion.get_mbd_musicgen()
+        print("MultiBandDiffusion loaded successfully.")
+        return mbd
 
     def predict(
         self,
         model_version: str = Input(
             description="Model to use for generation",
             default="stereo-melody-large",
-            choices=[
-                "stereo-melody-large",
-                "stereo-large",
-                "melody-large",
-                "large",
-            ],
+            choices=MODEL_VERSIONS,
         ),
         prompt: str = Input(
-            description="A description of the music you want to generate.", default=None
+            description="A description of the music you want to generate. Put one description per line to generate several pieces in a single batch.",
+            default=None,
         ),
         input_audio: Path = Input(
             description="An audio file that will influence the generated music. If `continuation` is `True`, the generated music will be a continuation of the audio file. Otherwise, the generated music will mimic the audio file's melody.",
             default=None,
         ),
         duration: int = Input(
-            description="Duration of the generated audio in seconds.", default=8
+            description="Duration of the generated audio in seconds.",
+            default=DEFAULT_DURATION,
         ),
         continuation: bool = Input(
             description="If `True`, generated music will continue from `input_audio`. Otherwise, generated music will mimic `input_audio`'s melody.",
@@ -131,9 +192,22 @@ class Predictor(BasePredictor):
             description="Seed for random number generator. If None or -1, a random seed will be used.",
             default=None,
         ),
-    ) -> Path:
+    ) -> List[Path]:
+        # Cog has uploaded the previous outputs by now.
+        if self.output_dir is not None:
+            shutil.rmtree(self.output_dir, ignore_errors=True)
+            self.output_dir = None
+
         if prompt is None and input_audio is None:
             raise ValueError("Must provide either prompt or input_audio")
+        # All descriptions are decoded together as one batch.
+        prompts = [line for line in (prompt or "").splitlines() if line.strip()]
+        if not prompts:
+            prompts = [None]
+        if len(prompts) > MAX_BATCH:
+            raise ValueError(
+                f"At most {MAX_BATCH} descriptions can be generated in one request, got {len(prompts)}."
+            )
         if continuation and not input_audio:
             raise ValueError("Must provide `input_audio` if continuation is `True`.")
         if (
@@ -150,14 +224,20 @@ class Predictor(BasePredictor):
             )
 
         if multi_band_diffusion and not hasattr(self, "mbd"):
-            print("Loading MultiBandDiffusion...")
-            self.weights_downloader.download_weights(
-                "models--facebook--multiband-diffusion", "models/hub"
-            )
-            self.mbd = MultiBandDiffusion.get_mbd_musicgen()
-            print("MultiBandDiffusion loaded successfully.")
+            self.mbd = self._load_mbd()
+
+        # Read the input audio in the background while the model is prepared.
+        if input_audio:
+            input_audio_future = self.executor.submit(torchaudio.load, input_audio)
 
-        if model_version not in self.loaded_models:
+        if model_version in self.loaded_models:
+            self.loaded_models.move_to_end(model_version)
+        else:
+            while len(self.loaded_models) >= MAX_LOADED_MODELS:
+                evicted = self.loaded_models.popitem(last=False)[0]
+                print(f"Unloading model {evicted}...")
+                gc.collect()
+                torch.cuda.empty_cache()
             print(f"Loading model {model_version}...")
             self.loaded_models[model_version] = self._load_model(
                 model_path=MODEL_PATH,
@@ -178,112 +258,131 @@ class Predictor(BasePredictor):
 
         if not seed or seed == -1:
             seed = torch.seed() % 2**32 - 1
-            set_all_seeds(seed)
-        set_all_seeds(seed)
+        seed_torch(seed)
         print(f"Using seed {seed}")
 
-        if not input_audio:
-            set_generation_params(duration)
-            wav, tokens = model.generate([prompt], progress=True, return_tokens=True)
-            if multi_band_diffusion:
-                wav = self.mbd.tokens_to_wav(tokens)
-
-        else:
-            input_audio, sr = torchaudio.load(input_audio)
-            input_audio = input_audio[None] if input_audio.dim() == 2 else input_audio
-
-            continuation_start = 0 if not continuation_start else continuation_start
-            if continuation_end is None or continuation_end == -1:
-                continuation_end = input_audio.shape[2] / sr
-
-            if continuation_start > continuation_end:
-                raise ValueError(
-                    "`continuation_start` must be less than or equal to `continuation_end`"
-                )
-
-            input_audio_wavform = input_audio[
-                ..., int(sr * continuation_start) : int(sr * continuation_end)
-            ]
-
-            if continuation:
+        try:
+            if not input_audio:
                 set_generation_params(duration)
-                wav, tokens = model.generate_continuation(
-                    prompt=input_audio_wavform,
-                    prompt_sample_rate=sr,
-                    descriptions=[prompt],
-                    progress=True,
-                    return_tokens=True,
-                )
-                if multi_band_diffusion:
-                    wav = self.mbd.tokens_to_wav(tokens)
+                with torch.inference_mode():
+                    wav, tokens = model.generate(
+                        prompts, progress=True, return_tokens=True
+                    )
+                    if multi_band_diffusion:
+                        wav = self.mbd.tokens_to_wav(tokens)
 
             else:
-                set_generation_params(duration)
-                wav, tokens = model.generate_with_chroma(
-                    [prompt], input_audio_wavform, sr, progress=True, return_tokens=True
+                input_audio, sr = input_audio_future.result()
+                input_audio = input_audio.to(self.device)
+                input_audio = input_audio[None] if input_audio.dim() == 2 else input_audio
+
+                continuation_start = 0 if not continuation_start else continuation_start
+                if continuation_end is None or continuation_end == -1:
+                    continuation_end = input_audio.shape[2] / sr
+
+                if continuation_start > continuation_end:
+                    raise ValueError(
+                        "`continuation_start` must be less than or equal to `continuation_end`"
+                    )
+
+                input_audio_wavform = input_audio[
+                    ..., int(sr * continuation_start) : int(sr * continuation_end)
+                ].expand(len(prompts), -1, -1)
+
+                if continuation:
+                    set_generation_params(duration)
+                    with torch.inference_mode():
+                        wav, tokens = model.generate_continuation(
+                            prompt=input_audio_wavform,
+                            prompt_sample_rate=sr,
+                            descriptions=prompts,
+                            progress=True,
+                            return_tokens=True,
+                        )
+                        if multi_band_diffusion:
+                            wav = self.mbd.tokens_to_wav(tokens)
+
+                else:
+                    set_generation_params(duration)
+                    with torch.inference_mode():
+                        wav, tokens = model.generate_with_chroma(
+                            prompts,
+                            input_audio_wavform,
+                            sr,
+                            progress=True,
+                            return_tokens=True,
+                        )
+                        if multi_band_diffusion:
+                            wav = self.mbd.tokens_to_wav(tokens)
+        finally:
+            # Text encodings are reused across chunks of this request only.
+            clear_text_cache(model)
+
+        # 16-bit samples are the most any output format needs.
+        self.output_dir = make_output_dir(wav.numel() * 2)
+        paths = []
+        for i, output in enumerate(wav.float()):
+            path = os.path.join(self.output_dir, f"out-{i}.{output_format}")
+            # Normalize and quantize to 16-bit PCM on the device that produced
+            # the audio, so only 2 bytes per sample are copied to the host.
+            with torch.inference_mode():
+                output = normalize_audio(
+                    output,
+                    strategy=normalization_strategy,
+                    log_clipping=True,
+                    sample_rate=model.sample_rate,
+                    stem_name=path,
                 )
-                if multi_band_diffusion:
-                    wav = self.mbd.tokens_to_wav(tokens)
-
-        audio_write(
-            "out",
-            wav[0].cpu(),
-            model.sample_rate,
-            strategy=normalization_strategy,
-        )
-        wav_path = "out.wav"
-
-        if output_format == "mp3":
-            mp3_path = "out.mp3"
-            if os.path.isfile(mp3_path):
-                os.remove(mp3_path)
-            subprocess.call(["ffmpeg", "-i", wav_path, mp3_path])
-            os.remove(wav_path)
-            path = mp3_path
-        else:
-            path = wav_path
-
-        return Path(path)
-
-    def _preprocess_audio(
-        audio_path, model: MusicGen, duration: tp.Optional[int] = None
-    ):
-        wav, sr = torchaudio.load(audio_path)
-        wav = torchaudio.functional.resample(wav, sr, model.sample_rate)
-        wav = wav.mean(dim=0, keepdim=True)
+                output = i16_pcm(output).cpu()
+            if output_format == "mp3":
+                torchaudio.save(path, output, model.sample_rate, format="mp3")
+            else:
+                torchaudio.save(
+                    path,
+                    output,
+                    model.sample_rate,
+                    encoding="PCM_S",
+                    bits_per_sample=16,
+                )
+            paths.append(Path(path))
 
-        # Calculate duration in seconds if not provided
-        if duration is None:
-            duration = wav.shape[1] / model.sample_rate
+        return paths
 
-        # Check if duration is more than 30 seconds
-        if duration > 30:
-            raise ValueError("Duration cannot be more than 30 seconds")
 
-        end_sample = int(model.sample_rate * duration)
-        wav = wav[:, :end_sample]
+# From https://gist.github.com/gatheluck/c57e2a40e3122028ceaecc3cb0d152ac
+def set_all_seeds(seed):
+    random.seed(seed)
+    os.environ["PYTHONHASHSEED"] = str(seed)
+    np.random.seed(seed)
+    seed_torch(seed)
 
-        assert wav.shape[0] == 1
-        assert wav.shape[1] == model.sample_rate * duration
 
-        wav = wav.cuda()
-        wav = wav.unsqueeze(1)
+def make_output_dir(size_bytes):
+    # Cog reads the outputs back anyway, so write them to memory-backed storage
+    # when it has room to spare (Docker's default /dev/shm is only 64 MB).
+    if (
+        os.path.isdir(TMPFS_DIR)
+        and shutil.disk_usage(TMPFS_DIR).free > 2 * size_bytes
+    ):
+        return tempfile.mkdtemp(dir=TMPFS_DIR)
+    return tempfile.mkdtemp()
 
-        with torch.no_grad():
-            gen_audio = model.compression_model.encode(wav)
 
-        codes, scale = gen_audio
+def log_progress(generated_tokens, tokens_to_generate):
+    # MusicGen reports progress after every decoding step; print sparingly.
+    # The codebook delay pattern runs a few steps past the reported total.
+    if generated_tokens % 50 == 0 and generated_tokens < tokens_to_generate:
+        print(f"{generated_tokens: 6d} / {tokens_to_generate: 6d}")
+    elif generated_tokens == tokens_to_generate:
+        print(f"{tokens_to_generate: 6d} / {tokens_to_generate: 6d}")
 
-        assert scale is None
 
-        return codes
+def clear_text_cache(model):
+    for conditioner in model.lm.condition_provider.conditioners.values():
+        if isinstance(conditioner, T5Conditioner):
+            conditioner.clear_cache()
 
 
-# From https://gist.github.com/gatheluck/c57e2a40e3122028ceaecc3cb0d152ac
-def set_all_seeds(seed):
-    random.seed(seed)
-    os.environ["PYTHONHASHSEED"] = str(seed)
-    np.random.seed(seed)
+def seed_torch(seed):
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
+    torch.cuda.manual_seed_all(seed)